@@ -0,0 +1,324 @@
+import ctypes
+import ctypes.util
+import os
+import shutil
+import sys
+import threading
+
+# In-process replacement for the flac executable, used by flacr.py when libFLAC can be loaded.
+# Every worker thread keeps one encoder and one decoder instance and reuses them for all of its files,
+# so no process has to be spawned per file.
+
+# Shared library names to try if ctypes.util.find_library does not find libFLAC, newest ABI first
+LIBRARY_NAMES = ["libFLAC.so.14", "libFLAC.so.12", "libFLAC.so.8",
+                 "libFLAC.14.dylib", "libFLAC.12.dylib", "libFLAC.8.dylib",
+                 "libFLAC.dll", "FLAC.dll"]
+
+# Encoding settings, equal to "flac --best --verify --padding=4096"
+COMPRESSION_LEVEL = 8
+PADDING = 4096
+# Seek point spacing in seconds, equal to the default "-S 10s" of the flac executable
+SEEKPOINT_INTERVAL = 10
+
+METADATA_TYPE_STREAMINFO = 0
+METADATA_TYPE_PADDING = 1
+METADATA_TYPE_SEEKTABLE = 3
+
+DECODER_END_OF_STREAM = 4
+ENCODER_UNINITIALIZED = 1
+
+WRITE_STATUS_CONTINUE = 0
+WRITE_STATUS_ABORT = 1
+
+class _StreamInfo(ctypes.Structure):
+    _fields_ = [("min_blocksize", ctypes.c_uint),
+                ("max_blocksize", ctypes.c_uint),
+                ("min_framesize", ctypes.c_uint),
+                ("max_framesize", ctypes.c_uint),
+                ("sample_rate", ctypes.c_uint),
+                ("channels", ctypes.c_uint),
+                ("bits_per_sample", ctypes.c_uint),
+                ("total_samples", ctypes.c_uint64),
+                ("md5sum", ctypes.c_ubyte * 16)]
+
+class _StreamMetadata(ctypes.Structure):
+    # Only the STREAMINFO member of the data union is ever read
+    _fields_ = [("type", ctypes.c_int),
+                ("is_last", ctypes.c_int),
+                ("length", ctypes.c_uint),
+                ("stream_info", _StreamInfo)]
+
+class _FrameHeader(ctypes.Structure):
+    # The blocksize is the leading member of FLAC__Frame, nothing else is needed
+    _fields_ = [("blocksize", ctypes.c_uint)]
+
+_WRITE_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_FrameHeader), ctypes.c_void_p, ctypes.c_void_p)
+_METADATA_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p)
+_ERROR_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+
+_PROTOTYPES = {
+    "FLAC__stream_decoder_new": (ctypes.c_void_p, []),
+    "FLAC__stream_decoder_delete": (None, [ctypes.c_void_p]),
+    "FLAC__stream_decoder_set_md5_checking": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_int]),
+    "FLAC__stream_decoder_set_metadata_respond_all": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_decoder_init_file": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p, _WRITE_CALLBACK, _METADATA_CALLBACK, _ERROR_CALLBACK, ctypes.c_void_p]),
+    "FLAC__stream_decoder_process_until_end_of_metadata": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_decoder_process_until_end_of_stream": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_decoder_get_state": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_decoder_finish": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_encoder_new": (ctypes.c_void_p, []),
+    "FLAC__stream_encoder_delete": (None, [ctypes.c_void_p]),
+    "FLAC__stream_encoder_set_channels": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "FLAC__stream_encoder_set_bits_per_sample": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "FLAC__stream_encoder_set_sample_rate": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "FLAC__stream_encoder_set_total_samples_estimate": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint64]),
+    "FLAC__stream_encoder_set_compression_level": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "FLAC__stream_encoder_set_verify": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_int]),
+    "FLAC__stream_encoder_set_metadata": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_uint]),
+    "FLAC__stream_encoder_init_file": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p]),
+    "FLAC__stream_encoder_process": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint]),
+    "FLAC__stream_encoder_get_state": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__stream_encoder_finish": (ctypes.c_int, [ctypes.c_void_p]),
+    "FLAC__metadata_object_new": (ctypes.c_void_p, [ctypes.c_int]),
+    "FLAC__metadata_object_clone": (ctypes.c_void_p, [ctypes.c_void_p]),
+    "FLAC__metadata_object_delete": (None, [ctypes.c_void_p]),
+    "FLAC__metadata_object_seektable_template_append_spaced_points_by_samples": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint64]),
+    "FLAC__metadata_object_seektable_template_sort": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_int]),
+}
+
+def _library_candidates():
+    yield ctypes.util.find_library("FLAC")
+    # Windows does not search PATH for DLLs, but the flac download ships libFLAC.dll next to flac.exe,
+    # which the README has users put on PATH
+    flac_executable = shutil.which("flac") if sys.platform == "win32" else None
+    if flac_executable is not None:
+        folder = os.path.dirname(os.path.realpath(flac_executable))
+        yield from (os.path.join(folder, name) for name in LIBRARY_NAMES if name.endswith(".dll"))
+    yield from LIBRARY_NAMES
+
+def _load_library():
+    for name in _library_candidates():
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+            for function, (restype, argtypes) in _PROTOTYPES.items():
+                getattr(lib, function).restype = restype
+                getattr(lib, function).argtypes = argtypes
+        except (OSError, AttributeError):
+            # Missing library or a libFLAC version without one of the required functions
+            continue
+        return lib
+    return None
+
+_lib = _load_library()
+_local = threading.local()
+
+def available():
+    return _lib is not None
+
+def vendor_string():
+    # Written to the VORBIS_COMMENT block of every encoded file, e.g. "reference libFLAC 1.4.3 20230623"
+    return ctypes.c_char_p.in_dll(_lib, "FLAC__VENDOR_STRING").value.decode("utf-8", "replace")
+
+def _status_string(table, index):
+    # libFLAC exports its state and status names as arrays of C strings
+    strings = ctypes.cast(ctypes.addressof(ctypes.c_char_p.in_dll(_lib, table)), ctypes.POINTER(ctypes.c_char_p))
+    return strings[index].decode("ascii")
+
+def _encode_path(path):
+    # libFLAC expects UTF-8 file names on Windows and the file system encoding everywhere else
+    return path.encode("utf-8") if sys.platform == "win32" else os.fsencode(path)
+
+def _read_ahead(file_path):
+    # Let the kernel read the whole file in large requests in the background,
+    # so the decoder's small reads are served from the page cache
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        # The decoder reports files that cannot be opened
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+class _Codec:
+    def __init__(self):
+        self.decoder = _lib.FLAC__stream_decoder_new()
+        self.encoder = _lib.FLAC__stream_encoder_new()
+        # libFLAC only stores raw pointers, the callback objects have to live as long as the codec
+        self._write_callback = _WRITE_CALLBACK(self._write)
+        self._metadata_callback = _METADATA_CALLBACK(self._metadata)
+        self._error_callback = _ERROR_CALLBACK(self._error)
+        # The padding block is the same for every file, so it is created once per codec
+        self.padding = _lib.FLAC__metadata_object_new(METADATA_TYPE_PADDING)
+        ctypes.cast(self.padding, ctypes.POINTER(_StreamMetadata)).contents.length = PADDING
+        self._reset()
+
+    def __del__(self):
+        if _lib is not None:
+            _lib.FLAC__stream_decoder_delete(self.decoder)
+            _lib.FLAC__stream_encoder_delete(self.encoder)
+            _lib.FLAC__metadata_object_delete(self.padding)
+
+    def _reset(self):
+        self.stream_info = None
+        self.metadata = []
+        self.errors = []
+        self.keep_metadata = False
+        self.encoding = False
+
+    def _recover_encoder(self):
+        # After a failed init or finish the encoder can stay in an error state, which makes every later
+        # init fail as well. finish() usually resets it, otherwise it is replaced by a new one.
+        _lib.FLAC__stream_encoder_finish(self.encoder)
+        if _lib.FLAC__stream_encoder_get_state(self.encoder) != ENCODER_UNINITIALIZED:
+            _lib.FLAC__stream_encoder_delete(self.encoder)
+            self.encoder = _lib.FLAC__stream_encoder_new()
+
+    def _write(self, decoder, frame, buffer, client_data):
+        # Decoded frames are handed to the encoder as they are, both use the same per-channel layout
+        if self.encoding and not _lib.FLAC__stream_encoder_process(self.encoder, buffer, frame.contents.blocksize):
+            return WRITE_STATUS_ABORT
+        return WRITE_STATUS_CONTINUE
+
+    def _metadata(self, decoder, metadata, client_data):
+        block = ctypes.cast(metadata, ctypes.POINTER(_StreamMetadata)).contents
+        if block.type == METADATA_TYPE_STREAMINFO:
+            info = block.stream_info
+            self.stream_info = (info.sample_rate, info.channels, info.bits_per_sample, info.total_samples)
+        elif self.keep_metadata and block.type not in (METADATA_TYPE_PADDING, METADATA_TYPE_SEEKTABLE):
+            # Tags, pictures etc. are copied, padding and seek table are replaced by new ones
+            self.metadata.append(_lib.FLAC__metadata_object_clone(metadata))
+
+    def _error(self, decoder, status, client_data):
+        self.errors.append(_status_string("FLAC__StreamDecoderErrorStatusString", status))
+
+    def _init_decoder(self, file_path):
+        _lib.FLAC__stream_decoder_set_md5_checking(self.decoder, True)
+        if self.keep_metadata:
+            _lib.FLAC__stream_decoder_set_metadata_respond_all(self.decoder)
+        status = _lib.FLAC__stream_decoder_init_file(self.decoder, _encode_path(file_path), self._write_callback,
+                                                     self._metadata_callback, self._error_callback, None)
+        if status != 0:
+            return f"{os.path.basename(file_path)}: ERROR initializing decoder\n  init status = {_status_string('FLAC__StreamDecoderInitStatusString', status)}\n"
+        return None
+
+    def _decoder_error(self, file_path):
+        if self.errors:
+            return "".join(f"{os.path.basename(file_path)}: *** Got error code {error}\n" for error in self.errors)
+        state = _lib.FLAC__stream_decoder_get_state(self.decoder)
+        if state > DECODER_END_OF_STREAM:
+            return f"{os.path.basename(file_path)}: ERROR while decoding data\n  state = {_status_string('FLAC__StreamDecoderStateString', state)}\n"
+        return None
+
+    def _finish_decoder(self, file_path, error):
+        # finish() also compares the MD5 signature of the decoded audio to the one in STREAMINFO
+        if not _lib.FLAC__stream_decoder_finish(self.decoder) and error is None:
+            error = f"{os.path.basename(file_path)}: ERROR, MD5 signature mismatch\n"
+        return error
+
+    def verify(self, file_path):
+        self._reset()
+        _read_ahead(file_path)
+        error = self._init_decoder(file_path)
+        if error:
+            return error
+        _lib.FLAC__stream_decoder_process_until_end_of_stream(self.decoder)
+        return self._finish_decoder(file_path, self._decoder_error(file_path))
+
+    def reencode(self, file_path, temp_file_path):
+        self._reset()
+        self.keep_metadata = True
+        _read_ahead(file_path)
+        error = self._init_decoder(file_path)
+        if error:
+            return error
+        blocks = []
+        try:
+            _lib.FLAC__stream_decoder_process_until_end_of_metadata(self.decoder)
+            error = self._decoder_error(file_path)
+            if error is None and self.stream_info is None:
+                error = f"{os.path.basename(file_path)}: ERROR, missing STREAMINFO block\n"
+            if error:
+                _lib.FLAC__stream_decoder_finish(self.decoder)
+                return error
+            sample_rate, channels, bits_per_sample, total_samples = self.stream_info
+
+            if total_samples:
+                seektable = _lib.FLAC__metadata_object_new(METADATA_TYPE_SEEKTABLE)
+                blocks.append(seektable)
+                _lib.FLAC__metadata_object_seektable_template_append_spaced_points_by_samples(seektable, sample_rate * SEEKPOINT_INTERVAL, total_samples)
+                _lib.FLAC__metadata_object_seektable_template_sort(seektable, True)
+            # Seek table first, then the copied blocks in their original order, padding last
+            ordered = blocks + self.metadata + [self.padding]
+
+            # finish() resets all settings to their defaults, so they are applied for every file
+            encoder = self.encoder
+            _lib.FLAC__stream_encoder_set_channels(encoder, channels)
+            _lib.FLAC__stream_encoder_set_bits_per_sample(encoder, bits_per_sample)
+            _lib.FLAC__stream_encoder_set_sample_rate(encoder, sample_rate)
+            _lib.FLAC__stream_encoder_set_total_samples_estimate(encoder, total_samples)
+            _lib.FLAC__stream_encoder_set_compression_level(encoder, COMPRESSION_LEVEL)
+            _lib.FLAC__stream_encoder_set_verify(encoder, True)
+            _lib.FLAC__stream_encoder_set_metadata(encoder, (ctypes.c_void_p * len(ordered))(*ordered), len(ordered))
+            status = _lib.FLAC__stream_encoder_init_file(encoder, _encode_path(temp_file_path), None, None)
+            if status != 0:
+                _lib.FLAC__stream_decoder_finish(self.decoder)
+                self._recover_encoder()
+                return f"{os.path.basename(file_path)}: ERROR initializing encoder\n  init status = {_status_string('FLAC__StreamEncoderInitStatusString', status)}\n"
+
+            self.encoding = True
+            _lib.FLAC__stream_decoder_process_until_end_of_stream(self.decoder)
+            self.encoding = False
+            error = self._finish_decoder(file_path, self._decoder_error(file_path))
+            encoder_state = _lib.FLAC__stream_encoder_get_state(encoder)
+            if not _lib.FLAC__stream_encoder_finish(encoder):
+                self._recover_encoder()
+                if error is None:
+                    error = f"{os.path.basename(file_path)}: ERROR during encoding\n  state = {_status_string('FLAC__StreamEncoderStateString', encoder_state)}\n"
+            return error
+        finally:
+            for block in blocks + self.metadata:
+                _lib.FLAC__metadata_object_delete(block)
+
+def _codec():
+    codec = getattr(_local, "codec", None)
+    if codec is None:
+        codec = _local.codec = _Codec()
+    return codec
+
+def init_worker():
+    # Initializer for worker processes, sets up the codec before the first file arrives
+    _codec()
+
+def verify_flac(file_path):
+    return file_path, _codec().verify(file_path)
+
+def reencode_flac(file_path):
+    # Define the temporary output file path. The original stays untouched until the new file
+    # has been fully written and verified, rewriting it in place would lose it on any failure.
+    temp_file_path = file_path + ".tmp"
+
+    error = _codec().reencode(file_path, temp_file_path)
+    if not error:
+        # Keep modification time and permissions of the original like the flac command does by default
+        # (--preserve-modtime). Like flac, a file system that refuses them doesn't fail the file.
+        try:
+            shutil.copystat(file_path, temp_file_path)
+        except OSError:
+            pass
+        # Same as in reencode_flac of flacr.py
+        try:
+            os.replace(temp_file_path, file_path)
+            return file_path, None
+        except PermissionError as e:
+            error = f"Could not replace the original file: {e}"
+    try:
+        os.remove(temp_file_path)
+    except FileNotFoundError:
+        pass
+    return file_path, error
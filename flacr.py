@@ -6,20 +6,48 @@ import argparse
 import shutil
 import getpass
 import concurrent.futures
-from tqdm import tqdm
+import functools
+import itertools
+import tempfile
+import threading
+import queue
+import sqlite3
 from datetime import datetime
 
+try:
+    # Optional in-process libFLAC backend, the flac executable is used if it is missing
+    import flac_backend
+except ImportError:
+    flac_backend = None
+
+# Looked up once, argument parsing and the rsgain thread cap all need it
+CPU_COUNT = multiprocessing.cpu_count()
+# Redrawing twice a second is plenty for runs that take minutes
+PROGRESS_OPTIONS = {"mininterval": 0.5}
+# Number of processed files after which the encoding/verifying progress bar is updated
+PROGRESS_BATCH_SIZE = 16
+# Number of files after which a libFLAC worker process is replaced by a new one
+FILES_PER_WORKER = 64
+# Stored in the scanned directory, remembers which files were recompressed
+CACHE_FILE = ".flacr_cache.sqlite"
+# Number of recompressed files after which they are saved to the cache
+CACHE_BATCH_SIZE = 100
+
+# Per-thread state of the workers that call the flac executable
+worker_state = threading.local()
+
 def parse_arguments():
     def dir_path(path):
         if os.path.isdir(path) and path != None:
-            return path
+            # Resolved once here, every path found below it is absolute without further abspath calls
+            return os.path.abspath(path)
         else:
             raise argparse.ArgumentTypeError(f"readable_dir:{path} is not a valid path")
     
     class thread_count:
         def __init__(self, string):
             self._val = int(string)
-            max_threads = multiprocessing.cpu_count()
+            max_threads = CPU_COUNT
             if not 0 < self._val <= max_threads:
                 raise argparse.ArgumentTypeError(f"Invalid thread count, supply a value between 1 and {max_threads}")
         def __int__(self):
@@ -28,14 +56,18 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Scan for .flac files in subdirectories, recompress them and optionally calculate replay gain tags.')
     parser.add_argument('-d', '--directory',
                         help='The directory that will be recursively scanned for .lrc and .txt files.', type=dir_path, default=".", const=".", nargs="?")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Recompress all files, including those that seem to have been recompressed with the same flac version before.')
     parser.add_argument('-l', '--log', action='count',
                         help='Log errors during recompression or testing to flacr.log.')
+    parser.add_argument('-L', '--legacy_flac', action='store_true',
+                        help='Call the flac executable for every file instead of encoding/decoding in-process with libFLAC.')
     parser.add_argument('-m', '--multi_threaded', type=thread_count, default=1, const=1, nargs="?",
                         help='The number of threads used during conversion and replay gain calculation, default: 1.')
     parser.add_argument('-p', '--progress', action='store_true',
                         help='Show progress bars during scanning/recompression/testing. Useful for huge directories. Requires tqdm, use "pip3 install tqdm" to install it.')
     parser.add_argument('-Q', '--quick', action='store_true',
-                        help='Equal to using -m with the max available threadcount, -r to calculate replay gain values and -p to display a progress bar.')
+                        help='Equal to using -m with the max available threadcount (up to 4 times as many when testing), -r to calculate replay gain values and -p to display a progress bar.')
     parser.add_argument('-r', '--rsgain', action='store_true',
                         help='Calculate replay gain values with rsgain and save them in the audio file tags.')
     parser.add_argument('-s', '--single_folder', action='store_true',
@@ -46,87 +78,431 @@ def parse_arguments():
     args: argparse.Namespace = parser.parse_args()
 
     if args.quick:
-        setattr(args, "multi_threaded", multiprocessing.cpu_count())
+        # Encoding is CPU bound and gets one worker per thread of the CPU.
+        # Testing mostly waits for the disk, so more workers keep it busy.
+        max_threads = CPU_COUNT
+        setattr(args, "multi_threaded", min(32, max_threads * 4) if args.test else max_threads)
         setattr(args, "rsgain", True)
         setattr(args, "progress", True)
  
     return args
 
+class NoProgress:
+    # Stands in for tqdm when no progress bars are shown, so tqdm is only imported (and needed) with -p
+    def __init__(self, *args, **kwargs):
+        self.total = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+    def update(self, n=1):
+        pass
+    def set_postfix(self, *args, **kwargs):
+        pass
+    def refresh(self):
+        pass
+
+def progress_bar(progress):
+    if not progress:
+        return NoProgress
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        print('tqdm is not installed, use "pip3 install tqdm" to install it or run without -p.')
+        sys.exit()
+    return tqdm
+
 def find_flac_files(directory, single_folder, progress):
-    flac_files = []
-    if not single_folder:
-        with tqdm(desc="searching", unit=" files", disable=not progress, ncols=100) as pbar:
-            flac_count = 0
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    pbar.update(1)
-                    if file.endswith(".flac"):
-                        flac_files.append(os.path.join(os.path.abspath(root), file))
-                        flac_count += 1
-                        pbar.set_postfix({"flac files": flac_count})
-    else:
-        with tqdm(desc="searching", unit=" files", disable=not progress, ncols=100) as pbar:
-            flac_count = 0
-            for file in os.listdir(directory):
-                if file.endswith(".flac"):
-                    flac_files.append(os.path.join(os.path.abspath(directory), file))
-                    flac_count += 1
-                    pbar.set_postfix({"flac files": flac_count})
-    return flac_files
+    # Updating tqdm for every single file costs more than the scan itself, so it is done in batches
+    batch_size = 512
+
+    def scan(path, subdirectories=None):
+        # Yields the number of files seen and the paths of the flac files among them in batches, so only
+        # the paths that are needed are kept and handed on. Subdirectories are collected in subdirectories
+        # if it is given, otherwise they are scanned as well.
+        # Directories still to be listed are kept on a stack instead of recursing, so every batch is yielded
+        # straight to the caller instead of being passed up through one generator per directory level
+        stack = [path]
+        seen = 0
+        found = []
+        while stack:
+            # DirEntry objects carry the file type from the directory listing, so no extra stat call is needed
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                # Unreadable directories are skipped, just like os.walk does
+                continue
+            with entries:
+                while True:
+                    # Errors while reading a directory (e.g. stale handles on network mounts) are handled like
+                    # os.walk does: the rest of that directory is skipped and entries of unknown type count as no directory
+                    try:
+                        entry = next(entries)
+                    except (StopIteration, OSError):
+                        break
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if subdirectories is not None:
+                            subdirectories.append(entry.path)
+                        else:
+                            stack.append(entry.path)
+                        continue
+                    seen += 1
+                    # Case-insensitive, so .FLAC and .Flac files are found as well. is_file() comes from the cached
+                    # file type, it only needs a stat call for symlinks and keeps out broken links, sockets and the like.
+                    if entry.name[-5:].lower() == ".flac":
+                        try:
+                            is_file = entry.is_file()
+                        except OSError:
+                            # e.g. symlink loops, which are no files either
+                            is_file = False
+                        if is_file:
+                            found.append(entry.path)
+                    if seen == batch_size:
+                        yield seen, found
+                        seen, found = 0, []
+        if seen:
+            yield seen, found
+
+    def scan_parallel(path):
+        # The top level subdirectories are scanned in parallel. os.scandir releases the GIL while it waits
+        # for the disk, which is where large or network mounted libraries spend most of the scan.
+        subdirectories = []
+        yield from scan(path, subdirectories)
+        if not subdirectories:
+            return
+        # The scanning threads hand their batches over as they find them. The queue is bounded, so they
+        # pause while the workers are behind instead of piling up the paths of the whole library.
+        batches = queue.Queue(maxsize=64)
+        stop = threading.Event()
+
+        def put(batch):
+            # Gives up once the search is abandoned, e.g. on Ctrl+C, so no thread stays blocked on a full queue
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def scan_subtree(subdirectory):
+            try:
+                for batch in scan(subdirectory):
+                    if stop.is_set():
+                        return
+                    put(batch)
+            finally:
+                # Marks the subtree as done
+                put(None)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(subdirectories))) as executor:
+            for subdirectory in subdirectories:
+                executor.submit(scan_subtree, subdirectory)
+            try:
+                remaining = len(subdirectories)
+                while remaining:
+                    batch = batches.get()
+                    if batch is None:
+                        remaining -= 1
+                    else:
+                        yield batch
+            finally:
+                stop.set()
+
+    with progress_bar(progress)(desc="searching", unit=" files", ncols=100, **PROGRESS_OPTIONS) as pbar:
+        flac_count = 0
+        # The directory is already absolute, which makes every path absolute as well
+        for seen, found in scan(directory, []) if single_folder else scan_parallel(directory):
+            flac_count += len(found)
+            yield from found
+            pbar.update(seen)
+            pbar.set_postfix({"flac files": flac_count})
     
+def stderr_file():
+    # Every worker thread reuses one temporary file for the stderr output of its flac processes,
+    # which saves setting up a pipe and a reader thread per file
+    err = getattr(worker_state, "stderr", None)
+    if err is None:
+        err = worker_state.stderr = tempfile.TemporaryFile()
+    err.seek(0)
+    err.truncate()
+    return err
+
+def read_stderr(err):
+    # flac is silent unless something went wrong, only read and decode the file if anything was written to it
+    if os.fstat(err.fileno()).st_size == 0:
+        return None
+    err.seek(0)
+    return err.read().decode("utf-8", "replace")
+
+def read_ahead(file_path):
+    # posix_fadvise is not available on Windows and macOS
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        # flac reports files that cannot be opened
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
 def verify_flac(file_path):
     # Define the verify command
-    command = ["flac", "-t", "--silent", file_path]
-    try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        return file_path, result.stderr
-    except subprocess.CalledProcessError as e:
-        return file_path, e.stderr
+    command = [which("flac"), "-t", "--silent", file_path]
+    err = stderr_file()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=err)
+    stderr = read_stderr(err)
+    # Like when re-encoding, flac may exit without a message
+    if result.returncode != 0 and not stderr:
+        stderr = f"flac exited with code {result.returncode}"
+    return file_path, stderr
 
 def reencode_flac(file_path):
     # Define the temporary output file path
     temp_file_path = file_path + ".tmp"
 
     # Define the re-encoding command
-    command = ["flac", "--best", "--verify", "--padding=4096", "--silent", file_path, "-o", temp_file_path]
+    command = [which("flac"), "--best", "--verify", "--padding=4096", "--silent", file_path, "-o", temp_file_path]
 
-    try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text = True, check=True)
-        if result.stderr:
-            print(f"Error encountered while re-encoding {file_path}:\n{result.stderr}")
-            os.remove(temp_file_path)
-        else:
-            # Replace the original file with the temporary file
+    # Let the kernel read the file ahead in large requests while flac starts up
+    read_ahead(file_path)
+    err = stderr_file()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=err)
+    stderr = read_stderr(err)
+    if result.returncode == 0 and not stderr:
+        # Replace the original file with the temporary file, a single atomic rename that also drops the old inode
+        try:
             os.replace(temp_file_path, file_path)
-        return file_path, result.stderr
-    except subprocess.CalledProcessError as e:
-        # If an error occurs, return the filepath and stderr
-        return file_path, e.stderr
+            return file_path, None
+        except PermissionError as e:
+            # On Windows, files that are open in another program can't be replaced, the original stays untouched
+            stderr = f"Could not replace the original file: {e}"
+    # A failed flac run does not always remove its output, no stray .tmp file is left next to the music
+    try:
+        os.remove(temp_file_path)
+    except FileNotFoundError:
+        pass
+    # If an error occurs, return the filepath and stderr. flac may exit without a message, e.g. when it crashes.
+    return file_path, stderr or f"flac exited with code {result.returncode}"
+
+def flac_vendor():
+    # flac writes "reference libFLAC <version> <date>" as vendor string, the version is taken from "flac --version"
+    try:
+        output = subprocess.run([which("flac"), "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.split()
+    except OSError:
+        return None
+    if len(output) < 2:
+        return None
+    return f"reference libFLAC {output[1]} "
+
+def already_recompressed(file_path, vendor):
+    # Only reads the metadata block headers at the start of the file. A file written by the same flac version
+    # with exactly the padding of the re-encoding command was most likely recompressed before, doing it again changes nothing.
+    padding = False
+    file_vendor = None
+    try:
+        with open(file_path, "rb") as f:
+            if f.read(4) != b"fLaC":
+                return False
+            is_last = False
+            while not is_last:
+                header = f.read(4)
+                if len(header) < 4:
+                    return False
+                is_last = header[0] & 0x80
+                block_type = header[0] & 0x7F
+                block_end = f.tell() + int.from_bytes(header[1:], "big")
+                if block_type == 1:
+                    padding = block_end - f.tell() == 4096
+                elif block_type == 4:
+                    # VORBIS_COMMENT, starts with the little endian length of the vendor string
+                    vendor_length = int.from_bytes(f.read(4), "little")
+                    file_vendor = f.read(vendor_length).decode("utf-8", "replace")
+                f.seek(block_end)
+    except OSError:
+        # Let the encoder report files that cannot be read
+        return False
+    return padding and file_vendor is not None and file_vendor.startswith(vendor)
+
+def skip_recompressed(reencode, vendor, file_path):
+    if already_recompressed(file_path, vendor):
+        return file_path, None
+    return reencode(file_path)
+
+def open_cache(directory):
+    # Remembers size and modification time of every recompressed file, so files that didn't change
+    # are skipped on the next run without even being opened
+    try:
+        cache = sqlite3.connect(os.path.join(directory, CACHE_FILE))
+        cache.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, vendor TEXT)")
+        # Files that rsgain is going to change, they are only saved to the cache after it ran.
+        # A temporary table lives on disk like the cache and disappears with the connection.
+        cache.execute("CREATE TEMP TABLE pending (path TEXT PRIMARY KEY)")
+    except sqlite3.Error as e:
+        print(f"Cannot use the cache file in {directory}, all files will be checked.\n{e}")
+        return None
+    return cache
+
+def unchanged(cache, vendor, file_path):
+    # Looked up one file at a time, nothing of the cache is kept in memory. Files recompressed by another
+    # flac version are left out, they are recompressed again.
+    try:
+        entry = cache.execute("SELECT size, mtime_ns FROM files WHERE path = ? AND vendor = ?", (file_path, vendor)).fetchone()
+    except sqlite3.Error:
+        return False
+    if entry is None:
+        return False
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    return entry == (stat.st_size, stat.st_mtime_ns)
+
+def save_cache(cache, paths, vendor):
+    # Size and modification time are taken now, after the files were written
+    entries = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((path, stat.st_size, stat.st_mtime_ns, vendor))
+    try:
+        # One transaction for all of them
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", entries)
+    except sqlite3.Error as e:
+        print(f"Could not update the cache file.\n{e}")
+
+def mark_pending(cache, paths):
+    try:
+        with cache:
+            cache.executemany("INSERT OR IGNORE INTO pending VALUES (?)", ((path,) for path in paths))
+    except sqlite3.Error as e:
+        print(f"Could not update the cache file.\n{e}")
+
+def save_pending(cache, vendor):
+    # Saves the files rsgain changed with their new size and modification time, a batch at a time
+    last = 0
+    while True:
+        try:
+            rows = cache.execute("SELECT rowid, path FROM pending WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, CACHE_BATCH_SIZE)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Could not update the cache file.\n{e}")
+            return
+        if not rows:
+            return
+        last = rows[-1][0]
+        save_cache(cache, [path for _, path in rows], vendor)
 
 def run_rsgain(directory, thread_count):
     #set rsgain thread count to at least 2 to prevent windows cli limitations to hinder performance
     if thread_count == 1: thread_count = 2
     # Define the replay gain calculation command
-    rs_gain_command = ["rsgain", "easy", "-m", str(thread_count), directory]
+    rs_gain_command = [which("rsgain"), "easy", "-m", str(thread_count), directory]
     try:
         subprocess.run(rs_gain_command, check=True)
     except subprocess.CalledProcessError as e:
+        # Nothing is left to abort at this point, the errors of the flac files still get reported
         print(f"Error while executing rsgain.\n{e}")
-        sys.exit()
 
-def write_log(error_log):
-    if not os.access(".", os.W_OK | os.X_OK):
-        print("Cannot write log file to current directory. Ensure that you have write permission. Skipping log creation.")
-        return
-    if len(error_log) > 0:
-        with open(f"flacr_error.log", "a", encoding="utf8") as log:
-            now = datetime.now()
-            log.write(f'\nflacr error log, date: {now.strftime("%Y-%m-%d %H:%M:%S")}\n')
-            for path, error in error_log:
-                log.write(f"{path}\n{error}\n")
+def submit_bounded(executor, fn, iterable, window):
+    # Keep at most `window` files in flight and submit the next one whenever one finishes,
+    # memory stays flat no matter how many files there are and the workers start before the search ends.
+    # Waiting on the small in-flight set keeps the bookkeeping per result independent of the number of files,
+    # and results arrive in the order they finish, so one slow file does not hold back the ones after it.
+    pending = set()
+    for item in iterable:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= window:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+def track_total(files, pbar):
+    # Pass the files through and set the total of the progress bar once all of them are known
+    count = 0
+    for filepath in files:
+        count += 1
+        yield filepath
+    pbar.total = count
+    pbar.refresh()
+
+def claim_worker_id(worker_counter):
+    # Worker processes share a multiprocessing.Value, threads a lock and an itertools.count
+    if isinstance(worker_counter, tuple):
+        lock, worker_ids = worker_counter
+        with lock:
+            return next(worker_ids)
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    return worker_id
+
+def init_worker(worker_counter, use_libflac):
+    # Pin every worker (and the flac processes it starts, they inherit it) to its own core so the scheduler
+    # doesn't move them around. There is no counter if the workers are not pinned.
+    if worker_counter is not None:
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[claim_worker_id(worker_counter)]})
+    if use_libflac:
+        flac_backend.init_worker()
+
+def create_executor(use_libflac, thread_count):
+    context = multiprocessing.get_context()
+    options = {}
+    recycle = False
+    if use_libflac and sys.version_info >= (3, 11):
+        # Replace worker processes after a number of files, so memory fragmentation can't build up over long runs.
+        # Python only supports this for worker processes that are started fresh instead of forked.
+        context = multiprocessing.get_context("spawn")
+        options = {"mp_context": context, "max_tasks_per_child": FILES_PER_WORKER}
+        recycle = True
+    # Only Linux supports pinning and only if there are enough cores for one worker each, otherwise the
+    # scheduling is left to the system. Replaced workers could not tell which core their predecessor freed,
+    # so they would end up sharing cores with live workers while others sit idle. A single worker has no
+    # siblings to be kept apart from and is better off on whichever core is free.
+    pin = thread_count > 1 and not recycle and hasattr(os, "sched_setaffinity") and thread_count <= len(os.sched_getaffinity(0))
+    worker_counter = None
+    if use_libflac:
+        if pin:
+            # Shared between the worker processes, needs working POSIX semaphores, so it is only created for pinning
+            worker_counter = context.Value("i", 0)
+        # libFLAC encodes inside the worker, separate processes keep the workers from competing for the GIL.
+        # Every process sets up its encoder and decoder once and reuses them for all files it gets.
+        return concurrent.futures.ProcessPoolExecutor(max_workers=thread_count, initializer=init_worker, initargs=(worker_counter, use_libflac), **options)
+    if pin:
+        worker_counter = (threading.Lock(), itertools.count())
+    # The flac executable does the work in its own process, threads are enough to wait for it
+    return concurrent.futures.ThreadPoolExecutor(max_workers=thread_count, initializer=init_worker, initargs=(worker_counter, use_libflac))
+
+def open_log():
+    # The log is only opened on the first error, so no log file is created if there are none.
+    # Line buffered, every error is written as soon as it occurs and none of them pile up in memory.
+    try:
+        log = open(f"flacr_error.log", "a", encoding="utf8", buffering=1)
+    except OSError as e:
+        print(f"Cannot write log file to current directory. Ensure that you have write permission. Errors will be printed instead.\n{e}")
+        return None
+    log.write(f'\nflacr error log, date: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n')
+    return log
+
+@functools.lru_cache(maxsize=None)
+def which(name):
+    # Looking up an executable stats every PATH entry (several per entry on Windows), so each one is only looked up once.
+    # flac and rsgain are started with the path found here, which also spares the system from searching PATH for every file.
+    return shutil.which(name)
 
 def flac_on_path():
-    if shutil.which("flac") is None and sys.platform == "win32":
+    if which("flac") is None and sys.platform == "win32":
         choice = input("flac executable is not on PATH, open environment variable settings in Windows to add it? (y/n): ")
         if choice == "y":
             print(f"""
@@ -156,14 +532,14 @@ def flac_on_path():
         else:
             print("Exiting.")
             sys.exit()
-    elif shutil.which("flac") is None:
+    elif which("flac") is None:
         print("flac is not on PATH, add it and try again.")
         sys.exit()
     else:
         return
     
 def rsgain_on_path():
-    if shutil.which("rsgain") is None and sys.platform == "win32":
+    if which("rsgain") is None and sys.platform == "win32":
         choice = input("rsgain executable is not on PATH, open environment variable settings in Windows to add it? (y/n): ")
         if choice == "y":
             print(f"""
@@ -193,76 +569,129 @@ def rsgain_on_path():
         else:
             print("Exiting.")
             sys.exit()
-    elif shutil.which("rsgain") is None:
+    elif which("rsgain") is None:
         print("rsgain is not on PATH, add it to PATH or execute the program again without -r.")
         sys.exit()
     else:
         return True
 
 def main(args):
-    args = parse_arguments()
     directory = args.directory
     log_to_disk = args.log
     thread_count = int(args.multi_threaded)
+    force = args.force
     progress = args.progress
     calc_rsgain = args.rsgain
     single_folder = args.single_folder
     test_run = args.test
+    use_libflac = not args.legacy_flac and flac_backend is not None and flac_backend.available()
 
-    # Check if flac.exe is available on PATH and abort if it is not.
-    flac_on_path()
+    if use_libflac:
+        verify, reencode = flac_backend.verify_flac, flac_backend.reencode_flac
+    else:
+        # Check if flac.exe is available on PATH and abort if it is not.
+        flac_on_path()
+        verify, reencode = verify_flac, reencode_flac
+    vendor = None
+    if not test_run:
+        # Identifies the flac version in use, files it recompressed before don't need to be recompressed again
+        vendor = flac_backend.vendor_string() if use_libflac else flac_vendor()
+    if vendor and not force:
+        reencode = functools.partial(skip_recompressed, reencode, vendor)
     if calc_rsgain:
         # Check if rsgain.exe is available on PATH and abort if it is not.
         calc_rsgain = rsgain_on_path()
 
-    # Collect paths of all .flac files
+    # Search for .flac files, they are processed while the search is still running
     flac_files = find_flac_files(directory, single_folder, progress)
+    cache = open_cache(directory) if vendor else None
+    # Paths of recompressed files that are not written to the cache yet, at most CACHE_BATCH_SIZE of them
+    finished = []
+    def flush_finished():
+        if calc_rsgain:
+            # rsgain changes the files, their cache entries are saved once it is done
+            mark_pending(cache, finished)
+        else:
+            save_cache(cache, finished, vendor)
+        finished.clear()
+    skipped = 0
+    if cache is not None and not force:
+        # With -f every file is recompressed, the cache is only updated
+        def skip_unchanged(files):
+            nonlocal skipped
+            for path in files:
+                if unchanged(cache, vendor, path):
+                    skipped += 1
+                    if calc_rsgain:
+                        finished.append(path)
+                        if len(finished) == CACHE_BATCH_SIZE:
+                            flush_finished()
+                else:
+                    yield path
+        flac_files = skip_unchanged(flac_files)
+    file_count = 0
     error_log = []
     error_count = 0
-    # Calculate replay gain tags and write them to the tags
-    if calc_rsgain:
-        run_rsgain(directory, thread_count)
-    if not test_run:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-            # Submit tasks to the executor
-            futures = {executor.submit(reencode_flac, filepath): filepath for filepath in flac_files}
-            
-            # Track progress using tqdm
-            with tqdm(total=len(flac_files), desc="encoding", unit=" files", disable=not progress, ncols=100) as pbar:
-                for future in concurrent.futures.as_completed(futures):
-                    filepath, stderr = future.result()
-                    if stderr:
+    log = None
+    # One file running and one queued per worker is enough to never leave a worker idle
+    window = thread_count * 2
+    # Re-encoding decodes every file and verifies the result, so a separate test run is not needed on top of it.
+    # Skipped files are not decoded though, only -f or a test run checks those.
+    process, description = (verify, "verifying") if test_run else (reencode, "encoding")
+    with create_executor(use_libflac, thread_count) as executor:
+        # Track progress using tqdm, the total is known once the search is done
+        with progress_bar(progress)(desc=description, unit=" files", ncols=100, **PROGRESS_OPTIONS) as pbar:
+            # Like in the search, tqdm is updated in batches, but right away when the error count changes
+            pending = 0
+            for filepath, stderr in submit_bounded(executor, process, track_total(flac_files, pbar), window):
+                file_count += 1
+                pending += 1
+                if stderr:
+                    error_count += 1
+                    if log is None and log_to_disk:
+                        log = open_log()
+                        log_to_disk = log is not None
+                    if log is not None:
+                        # One write per error, text mode is kept for the platform's line endings
+                        log.write(f"{filepath}\n{stderr}\n")
+                    else:
                         error_log.append((filepath, stderr))
-                        error_count += 1
-                        pbar.set_postfix({"errors": error_count})
-                    pbar.update(1)
-    else:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-            # Submit tasks to the executor
-            futures = {executor.submit(verify_flac, filepath): filepath for filepath in flac_files}
-
-            # Track progress using tqdm
-            with tqdm(total=len(flac_files), desc="verifying", unit=" files", disable=not progress, ncols=100) as pbar:
-                for future in concurrent.futures.as_completed(futures):
-                    filepath, stderr = future.result()
+                elif cache is not None:
+                    finished.append(filepath)
+                    if len(finished) == CACHE_BATCH_SIZE:
+                        flush_finished()
+                if stderr or pending == PROGRESS_BATCH_SIZE:
+                    pbar.update(pending)
+                    pending = 0
                     if stderr:
-                        error_log.append((filepath, stderr))
-                        error_count += 1
                         pbar.set_postfix({"errors": error_count})
-                    pbar.update(1)
-    
-    if log_to_disk:
-        write_log(error_log)
-    else:
-        for path, error in error_log:
-            print (f"Encountered error when processing file:\n{path}\n{error}")
-    percentage = (error_count / len(flac_files)) * 100 if len(flac_files) > 0 else 0
-    print(f"\n{len(flac_files)} flac files processed, {error_count} errors. Error rate: {percentage:.2f} %.")
+            pbar.update(pending)
+
+    # Calculate replay gain tags and write them to the tags. This happens after re-encoding, because
+    # running both at once would let the re-encoded files overwrite the tags rsgain just wrote.
+    if calc_rsgain:
+        run_rsgain(directory, min(thread_count, CPU_COUNT))
+    if cache is not None:
+        flush_finished()
+        if calc_rsgain:
+            save_pending(cache, vendor)
+        cache.close()
+
+    if log is not None:
+        log.close()
+    # The report is printed with a single write, so nothing can end up between its lines
+    report = [f"Encountered error when processing file:\n{path}\n{error}" for path, error in error_log]
+    # Skipped files count as processed, the same as files skipped because their metadata shows they were recompressed
+    file_count += skipped
+    if skipped > 0:
+        report.append(f"\n{skipped} flac files skipped, they did not change since they were recompressed.")
+    percentage = (error_count / file_count) * 100 if file_count > 0 else 0
+    report.append(f"\n{file_count} flac files processed, {error_count} errors. Error rate: {percentage:.2f} %.")
+    print("\n".join(report))
 
 if __name__ == "__main__":
-    args = parse_arguments()
     try:
-        main(args)
+        main(parse_arguments())
     except KeyboardInterrupt:
         print("Interrupted")
         try: